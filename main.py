@@ -1,5 +1,14 @@
+import sys
+import math
 import time
+import shutil
+import subprocess
 import threading
+import importlib.machinery
+import importlib.util
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import cv2
 import numpy as np
@@ -8,9 +17,31 @@ import customtkinter as ctk
 from pynput import keyboard
 import mss
 import os
+try:
+    from xxhash import xxh3_64_intdigest as zone_digest
+except ImportError:
+    from zlib import crc32 as zone_digest
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import cffi
+except ImportError:
+    cffi = None
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "1" # delete pygame trash in console
 import pygame
 
+bettercam = None
+if sys.platform == "win32":
+    try:
+        import bettercam  # DXGI desktop duplication, keeps the latest frame in a background thread
+    except ImportError:
+        pass
+
+# mss only sees XWayland windows, native Wayland sessions go through grim
+WAYLAND = os.environ.get("XDG_SESSION_TYPE") == "wayland" and shutil.which("grim") is not None
+
 # ----------------------------- sound -------------------------------------
 pygame.mixer.init()
 SOUND_PATH = "resources/whistle.wav"
@@ -20,6 +51,23 @@ else:
     start_sound = None
     print(f"[Warning] Звуковой файл {SOUND_PATH} не найден, звук отключен.")
 
+# ----------------------------- cuda -------------------------------------
+def _cuda_device_count():
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount()
+    except (AttributeError, cv2.error):  # OpenCV built without the cuda module
+        return 0
+
+USE_CUDA = _cuda_device_count() > 0
+
+# ----------------------------- opencv -------------------------------------
+# on the CPU path zones are matched on the worker's own thread pool, so OpenCV's
+# internal threads would only contend with it; OpenCL launch overhead dwarfs the
+# sub-millisecond matches on these small zones
+cv2.setUseOptimized(True)
+cv2.ocl.setUseOpenCL(False)
+cv2.setNumThreads((os.cpu_count() or 1) if USE_CUDA else 1)
+
 # ----------------------------- configuration -----------------------------
 
 TEMPLATES = [
@@ -78,43 +126,459 @@ REWARD_TEMPLATE = {
 }
 
 DEFAULT_DELAY = 1.0  # seconds
+CAMERA_MAX_FPS = 60  # cap for the bettercam capture thread
+MOUSE_POLL_MS = 250  # cursor position refresh in the GUI
+
+PYRAMID_LEVELS = 2  # coarse pass runs at 1/4 scale
+PYRAMID_MIN_SIDE = 8  # px, smallest template side allowed on the coarse level
+REFINE_MARGIN = 8  # px, full-resolution search radius around the coarse hit
+COARSE_REJECT = 0.6  # coarse score below COARSE_REJECT * threshold skips the refine pass
+SAMPLE_GRID = 4  # 4x4 template pixels checked before the coarse NCC
+SAMPLE_MAD_LIMIT = 40  # gray levels, mean |zone - template| over the zero-mean samples that still passes
+KERNEL_TRIALS = 5  # timed runs per matcher when choosing the coarse kernel
+KERNEL_CACHE = Path.home() / ".cache" / "blue-archive-autoplay"  # compiled C kernels, one per coarse size
+CLICK_DEBOUNCE = 3.0  # seconds before a match on unchanged pixels is clicked again
 
 # ----------------------------- utilities -----------------------------
 
 def load_template(path):
-    img = cv2.imread(str(path))
+    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
     if img is None:
         raise FileNotFoundError(f"Template not found or unreadable: {path}")
     return img
 
+_TLS = threading.local()
+
+def thread_sct():
+    """mss instance of the calling thread, opened on first use and reused for every later grab"""
+    sct = getattr(_TLS, "sct", None)
+    if sct is None:
+        sct = _TLS.sct = mss.mss()
+    return sct
+
+def release_thread_sct():
+    """Close the calling thread's mss instance, workers call it on exit so restarts do not leak displays"""
+    sct = getattr(_TLS, "sct", None)
+    if sct is not None:
+        sct.close()
+        _TLS.sct = None
+
+_SCREEN_SIZE = pyautogui.size()
+
+def refresh_screen_size():
+    """Re-read the resolution once per start, everything else uses the cached value"""
+    global _SCREEN_SIZE
+    _SCREEN_SIZE = pyautogui.size()
+    region_from_percent.cache_clear()
+
+@lru_cache(maxsize=None)
 def region_from_percent(zone):
-    screen_w, screen_h = pyautogui.size()
+    screen_w, screen_h = _SCREEN_SIZE
     x1 = int(screen_w * zone[0])
     y1 = int(screen_h * zone[1])
     x2 = int(screen_w * zone[2])
     y2 = int(screen_h * zone[3])
     return (x1, y1, x2 - x1, y2 - y1)
 
-def screenshot_region(region):
-    """Universal screenshot for X11 and Windows only"""
-    x, y, w, h = region
-    with mss.mss() as sct:
-        monitor = {"top": y, "left": x, "width": w, "height": h}
-        img = np.array(sct.grab(monitor))
-        return cv2.cvtColor(img[..., :3], cv2.COLOR_RGB2BGR)
+def union_region(regions):
+    """Bounding box of several (x, y, w, h) regions"""
+    x1 = min(r[0] for r in regions)
+    y1 = min(r[1] for r in regions)
+    x2 = max(r[0] + r[2] for r in regions)
+    y2 = max(r[1] + r[3] for r in regions)
+    return (x1, y1, x2 - x1, y2 - y1)
 
-def match_template(image, template, threshold):
-    gray_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray_tpl = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-    res = cv2.matchTemplate(gray_img, gray_tpl, cv2.TM_CCOEFF_NORMED)
+def regions_overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+def cluster_regions(regions):
+    """Union boxes of overlapping regions, and the index of the box holding each region"""
+    boxes = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if regions_overlap(boxes[i], boxes[j]):
+                    boxes[i] = union_region([boxes[i], boxes.pop(j)])
+                    merged = True
+                    break
+            if merged:
+                break
+    index = [next(k for k, b in enumerate(boxes) if union_region([b, r]) == b) for r in regions]
+    return boxes, index
+
+def build_pyramid(gray, levels):
+    """[full, 1/2, 1/4, ...] Gaussian pyramid of a grayscale image"""
+    pyr = [gray]
+    for _ in range(levels):
+        pyr.append(cv2.pyrDown(pyr[-1]))
+    return pyr
+
+def crop_pyramid(pyr, region, origin):
+    """Views of an absolute region on every level of a pyramid captured at origin (x, y)
+
+    The end is rounded up like pyrDown rounds the template's size up, so the coarse
+    score map still reaches the last full-resolution offsets at the right and bottom.
+    """
+    x, y, w, h = region
+    x -= origin[0]
+    y -= origin[1]
+    return [level[y >> k:-(-(y + h) >> k), x >> k:-(-(x + w) >> k)] for k, level in enumerate(pyr)]
+
+def result_view(buf, image, template):
+    """Contiguous float32 score map for image x template, carved out of a preallocated flat buffer"""
+    oh, ow = image.shape[0] - template.shape[0] + 1, image.shape[1] - template.shape[1] + 1
+    return buf[:oh * ow].reshape(oh, ow)
+
+def best_match(image, template, buf):
+    """Best TM_CCOEFF_NORMED score and its top-left corner, the score map is written into buf"""
+    res = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED, result=result_view(buf, image, template))
     _, max_val, _, max_loc = cv2.minMaxLoc(res)
-    if max_val >= threshold:
-        h, w = gray_tpl.shape
-        cx = max_loc[0] + w // 2
-        cy = max_loc[1] + h // 2
-        return (cx, cy)
+    return max_val, max_loc
+
+def make_numba_kernel(th, tw):
+    """TM_CCOEFF_NORMED kernel compiled by numba for one template size, th and tw are compile-time constants"""
+    n = th * tw
+
+    # nogil instead of parallel: the zones already run on the worker's thread pool
+    @njit(nogil=True, fastmath=True, boundscheck=False)
+    def kernel(image, tpl_zm, tpl_norm, out):
+        for y in range(out.shape[0]):
+            for x in range(out.shape[1]):
+                s = 0.0
+                s2 = 0.0
+                cross = 0.0
+                for dy in range(th):
+                    for dx in range(tw):
+                        v = float(image[y + dy, x + dx])
+                        s += v
+                        s2 += v * v
+                        cross += v * tpl_zm[dy, dx]
+                var = s2 - s * s / n
+                out[y, x] = cross / np.sqrt(var * tpl_norm) if var > 1e-6 else 0.0
+        return out
+
+    return kernel
+
+C_KERNEL_SOURCE = """
+#include <math.h>
+#include <stddef.h>
+#include <stdint.h>
+#define TH %d
+#define TW %d
+
+void match_ccoeff_u8(const uint8_t *img, int stride, int oh, int ow,
+                     const double *tpl, double tpl_norm, float *out)
+{
+    for (int y = 0; y < oh; y++)
+        for (int x = 0; x < ow; x++) {
+            const uint8_t *p = img + (ptrdiff_t)y * stride + x;
+            int32_t s = 0, s2 = 0;
+            double cross = 0.0;
+            for (int dy = 0; dy < TH; dy++)
+                for (int dx = 0; dx < TW; dx++) {
+                    int32_t v = p[dy * stride + dx];
+                    s += v;
+                    s2 += v * v;
+                    cross += v * tpl[dy * TW + dx];
+                }
+            double var = s2 - (double)s * s / (TH * TW);
+            out[(ptrdiff_t)y * ow + x] = var > 1e-6 ? (float)(cross / sqrt(var * tpl_norm)) : 0.0f;
+        }
+}
+"""
+C_KERNEL_CDEF = "void match_ccoeff_u8(const uint8_t *, int, int, int, const double *, double, float *);"
+C_KERNEL_FLAGS = ["/O2", "/fp:fast"] if sys.platform == "win32" else ["-O3", "-march=native", "-ffast-math"]
+
+def make_c_kernel(th, tw):
+    """Same kernel as C built through cffi with th and tw as #defines, or None without a working compiler
+
+    The extension is cached in KERNEL_CACHE under the size and a digest of the source,
+    so only the first start on a machine pays for the compile.
+    """
+    source = C_KERNEL_SOURCE % (th, tw)
+    name = f"ncc_{th}x{tw}_{zlib.crc32((source + ' '.join(C_KERNEL_FLAGS)).encode()):08x}"
+    path = KERNEL_CACHE / (name + importlib.machinery.EXTENSION_SUFFIXES[0])
+    if not path.exists():
+        ffi = cffi.FFI()
+        ffi.cdef(C_KERNEL_CDEF)
+        ffi.set_source(name, source, extra_compile_args=C_KERNEL_FLAGS)
+        KERNEL_CACHE.mkdir(parents=True, exist_ok=True)
+        try:
+            path = Path(ffi.compile(tmpdir=str(KERNEL_CACHE)))
+        except (cffi.VerificationError, ImportError, OSError) as e:
+            print(f"[Warning] C kernel {th}x{tw} not compiled, using cv2.matchTemplate: {e}")
+            return None
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    ffi, lib = module.ffi, module.lib
+
+    # cffi releases the GIL for the call, like the numba kernel's nogil
+    def kernel(image, tpl_zm, tpl_norm, out):
+        lib.match_ccoeff_u8(
+            ffi.cast("const uint8_t *", image.ctypes.data), image.strides[0], out.shape[0], out.shape[1],
+            ffi.cast("const double *", tpl_zm.ctypes.data), tpl_norm, ffi.cast("float *", out.ctypes.data),
+        )
+        return out
+
+    return kernel
+
+@lru_cache(maxsize=None)
+def make_match_kernel(th, tw):
+    """Specialized coarse kernel for one template size: numba if installed, else C through cffi, else None"""
+    if njit is not None:
+        return make_numba_kernel(th, tw)
+    if cffi is not None:
+        return make_c_kernel(th, tw)
+    return None
+
+def pick_kernel(image, t):
+    """Keep the specialized kernel only if it beats cv2.matchTemplate on a full coarse zone"""
+    tpl = t["pyr"][t["levels"]]
+    if image.shape[0] < tpl.shape[0] or image.shape[1] < tpl.shape[1]:
+        t["kernel"] = None  # zone smaller than the template, match_template never goes coarse
+        return
+    out = result_view(t["result"], image, tpl)
+    t["kernel"](image, t["coarse_zm"], t["coarse_norm"], out)  # first call compiles
+    timings = []
+    for run in (
+        lambda: cv2.matchTemplate(image, tpl, cv2.TM_CCOEFF_NORMED, result=out),
+        lambda: t["kernel"](image, t["coarse_zm"], t["coarse_norm"], out),
+    ):
+        start = time.perf_counter()
+        for _ in range(KERNEL_TRIALS):
+            run()
+        timings.append(time.perf_counter() - start)
+    if timings[1] >= timings[0]:
+        t["kernel"] = None
+
+def coarse_match(image, t):
+    """Coarse-level score and top-left, through the specialized kernel when pick_kernel kept it"""
+    tpl = t["pyr"][t["levels"]]
+    if t.get("kernel") is None:
+        return best_match(image, tpl, t["result"])
+    out = result_view(t["result"], image, tpl)
+    t["kernel"](image, t["coarse_zm"], t["coarse_norm"], out)
+    _, max_val, _, max_loc = cv2.minMaxLoc(out)
+    return max_val, max_loc
+
+def sample_prefilter(image, t):
+    """Candidate box of a coarse zone whose sampled pixels stay close to the template's, or None
+
+    Sums |zone - template| over a few sampled template pixels for every offset at once,
+    NCC then only runs on the box around the offsets that pass. The offsets span the
+    whole coarse crop, which crop_pyramid rounds up to reach the zone's last pixels.
+    Both sides are taken relative to their own sample mean, so a uniform brightness
+    shift (dimming overlay, hover tint) passes just like it does under TM_CCOEFF_NORMED.
+    """
+    th, tw = t["pyr"][t["levels"]].shape
+    oh, ow = image.shape[0] - th + 1, image.shape[1] - tw + 1
+    n = len(t["samples"])
+    # scaled by n to stay in integers: |n * zone - zone_sum - (n * val - val_sum)|
+    windows = [image[dy:dy + oh, dx:dx + ow].astype(np.int32) for dy, dx, _ in t["samples"]]
+    total = np.zeros((oh, ow), dtype=np.int32)
+    for win in windows:
+        total += win
+    val_sum = sum(val for _, _, val in t["samples"])
+    acc = np.zeros((oh, ow), dtype=np.int32)
+    for win, (_, _, val) in zip(windows, t["samples"]):
+        win *= n
+        win -= total
+        win -= n * val - val_sum
+        acc += np.abs(win, out=win)
+    ys, xs = np.nonzero(acc <= SAMPLE_MAD_LIMIT * n * n)
+    if not len(ys):
+        return None
+    # one coarse offset of slack on every side: the hit can fall between two coarse
+    # offsets, and the neighbour that fails the samples is still the one refine needs
+    y0, x0 = max(0, int(ys.min()) - 1), max(0, int(xs.min()) - 1)
+    return (x0, y0), image[y0:ys.max() + 1 + th, x0:xs.max() + 1 + tw]
+
+def match_template(crops, t):
+    """Coarse-to-fine match of a prepared template, crops[k] is the zone at pyramid level k"""
+    image = crops[0]
+    h, w = t["shape"]
+    ox = oy = 0
+    level = t["levels"]
+    coarse, coarse_tpl = crops[level], t["pyr"][level]
+    if level and coarse.shape[0] >= coarse_tpl.shape[0] and coarse.shape[1] >= coarse_tpl.shape[1]:
+        candidates = sample_prefilter(coarse, t)
+        if candidates is None:
+            return None
+        (px, py), coarse = candidates
+        score, (cx, cy) = coarse_match(coarse, t)
+        cx += px
+        cy += py
+        if score < COARSE_REJECT * t["threshold"]:
+            return None
+        # refine at full resolution in a small window around the upscaled coarse hit
+        ox = max(0, (cx << level) - REFINE_MARGIN)
+        oy = max(0, (cy << level) - REFINE_MARGIN)
+        image = image[oy:(cy << level) + h + REFINE_MARGIN, ox:(cx << level) + w + REFINE_MARGIN]
+    score, (mx, my) = best_match(image, t["gray"], t["result"])
+    if score >= t["threshold"]:
+        return (ox + mx + w // 2, oy + my + h // 2)
+    return None
+
+def match_template_cuda(frame_gpu, t, origin, stream):
+    """Full-resolution match of a prepared template on its zone of the uploaded frame"""
+    x, y, w, h = t["region_abs"]
+    zone = cv2.cuda_GpuMat(frame_gpu, (x - origin[0], y - origin[1], w, h))
+    t["matcher"].match(zone, t["tpl_gpu"], t["result_gpu"], stream)
+    stream.waitForCompletion()
+    _, max_val, _, max_loc = cv2.cuda.minMaxLoc(t["result_gpu"])
+    if max_val >= t["threshold"]:
+        th, tw = t["shape"]
+        return (max_loc[0] + tw // 2, max_loc[1] + th // 2)
     return None
 
+def prepare_template(t):
+    """Load a template once: grayscale pixels, their shape and pyramid, and the absolute scan region"""
+    t["gray"] = load_template(Path(t["path"]).resolve())
+    t["shape"] = t["gray"].shape
+    # stop going down before the template loses the detail the match relies on
+    t["levels"] = 0
+    while t["levels"] < PYRAMID_LEVELS and min(t["shape"]) >> (t["levels"] + 1) >= PYRAMID_MIN_SIDE:
+        t["levels"] += 1
+    t["pyr"] = build_pyramid(t["gray"], t["levels"])
+    # SAMPLE_GRID x SAMPLE_GRID pixels from cell centers of the coarse template
+    ch, cw = t["pyr"][-1].shape
+    t["samples"] = [
+        (int((i + 0.5) * ch / SAMPLE_GRID), int((j + 0.5) * cw / SAMPLE_GRID))
+        for i in range(SAMPLE_GRID) for j in range(SAMPLE_GRID)
+    ]
+    t["samples"] = [(dy, dx, int(t["pyr"][-1][dy, dx])) for dy, dx in t["samples"]]
+    # the specialized kernel is built and picked on the worker's first CPU scan
+    t["kernel"] = None
+    if t["levels"] and not USE_CUDA:
+        coarse = t["pyr"][-1].astype(np.float64)
+        t["coarse_zm"] = coarse - coarse.mean()
+        t["coarse_norm"] = float((t["coarse_zm"] ** 2).sum())
+    t["region_abs"] = region_from_percent(t["zone"])
+    # the full-resolution map over the whole zone is the largest any pass produces,
+    # coarse, prefiltered and refine maps all reuse the front of this buffer
+    rw, rh = t["region_abs"][2:]
+    th, tw = t["shape"]
+    t["result"] = np.empty((rh - th + 1) * (rw - tw + 1), dtype=np.float32)
+    if USE_CUDA:
+        # the template goes up once, only the frame is uploaded per cycle
+        t["tpl_gpu"] = cv2.cuda_GpuMat()
+        t["tpl_gpu"].upload(t["gray"])
+        t["result_gpu"] = cv2.cuda_GpuMat()
+        t["matcher"] = cv2.cuda.createTemplateMatching(cv2.CV_8UC1, cv2.TM_CCOEFF_NORMED)
+    return t
+
+# ----------------------------- input -----------------------------
+# one SendInput / XTest round trip per click or key press instead of pyautogui's per-event calls
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    INPUT_MOUSE = 0
+    INPUT_KEYBOARD = 1
+    MOUSEEVENTF_MOVE = 0x0001
+    MOUSEEVENTF_LEFTDOWN = 0x0002
+    MOUSEEVENTF_LEFTUP = 0x0004
+    MOUSEEVENTF_ABSOLUTE = 0x8000
+    KEYEVENTF_KEYUP = 0x0002
+    VK_CODES = {"esc": 0x1B, "enter": 0x0D}
+
+    class MOUSEINPUT(ctypes.Structure):
+        _fields_ = [("dx", wintypes.LONG), ("dy", wintypes.LONG), ("mouseData", wintypes.DWORD),
+                    ("dwFlags", wintypes.DWORD), ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+    class KEYBDINPUT(ctypes.Structure):
+        _fields_ = [("wVk", wintypes.WORD), ("wScan", wintypes.WORD), ("dwFlags", wintypes.DWORD),
+                    ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+    class HARDWAREINPUT(ctypes.Structure):
+        _fields_ = [("uMsg", wintypes.DWORD), ("wParamL", wintypes.WORD), ("wParamH", wintypes.WORD)]
+
+    class _INPUTUNION(ctypes.Union):
+        _fields_ = [("mi", MOUSEINPUT), ("ki", KEYBDINPUT), ("hi", HARDWAREINPUT)]
+
+    class INPUT(ctypes.Structure):
+        _fields_ = [("type", wintypes.DWORD), ("u", _INPUTUNION)]
+
+    _user32 = ctypes.windll.user32
+
+    def _send_input(*events):
+        _user32.SendInput(len(events), (INPUT * len(events))(*events), ctypes.sizeof(INPUT))
+
+    def _mouse_event(flags, dx=0, dy=0):
+        return INPUT(type=INPUT_MOUSE, u=_INPUTUNION(mi=MOUSEINPUT(dx=dx, dy=dy, dwFlags=flags)))
+
+    def _key_event(vk, flags=0):
+        scan = _user32.MapVirtualKeyW(vk, 0)
+        return INPUT(type=INPUT_KEYBOARD, u=_INPUTUNION(ki=KEYBDINPUT(wVk=vk, wScan=scan, dwFlags=flags)))
+
+    def click(x, y):
+        pyautogui.failSafeCheck()
+        sw, sh = _SCREEN_SIZE
+        # absolute moves are normalized to 0..65535 across the primary monitor
+        _send_input(
+            _mouse_event(MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE, x * 65535 // (sw - 1), y * 65535 // (sh - 1)),
+            _mouse_event(MOUSEEVENTF_LEFTDOWN),
+            _mouse_event(MOUSEEVENTF_LEFTUP),
+        )
+
+    def press(key):
+        pyautogui.failSafeCheck()
+        vk = VK_CODES[key]
+        _send_input(_key_event(vk), _key_event(vk, KEYEVENTF_KEYUP))
+
+    _cursor = wintypes.POINT()
+
+    def cursor_position():
+        _user32.GetCursorPos(ctypes.byref(_cursor))
+        return _cursor.x, _cursor.y
+
+else:
+    # GUI thread only: the XTest display below belongs to the worker
+    cursor_position = pyautogui.position
+
+    xtest = None
+    if not WAYLAND:
+        try:
+            from Xlib import X, XK, display as xdisplay
+            from Xlib.ext import xtest
+        except ImportError:  # python-xlib ships with pyautogui on Linux, but not everywhere
+            pass
+
+    if xtest is not None:
+        KEYSYMS = {"esc": "Escape", "enter": "Return"}
+        _xdisplay = None
+
+        def _display():
+            # opened by the worker on its first action, input only ever comes from that thread
+            global _xdisplay
+            if _xdisplay is None:
+                _xdisplay = xdisplay.Display()
+            return _xdisplay
+
+        def click(x, y):
+            pyautogui.failSafeCheck()
+            d = _display()
+            xtest.fake_input(d, X.MotionNotify, x=x, y=y)
+            xtest.fake_input(d, X.ButtonPress, 1)
+            xtest.fake_input(d, X.ButtonRelease, 1)
+            d.sync()
+
+        def press(key):
+            pyautogui.failSafeCheck()
+            d = _display()
+            code = d.keysym_to_keycode(XK.string_to_keysym(KEYSYMS[key]))
+            xtest.fake_input(d, X.KeyPress, code)
+            xtest.fake_input(d, X.KeyRelease, code)
+            d.sync()
+
+    else:
+        click = pyautogui.click
+        press = pyautogui.press
+
 # ----------------------------- worker -----------------------------
 
 class AutoClicker(threading.Thread):
@@ -126,60 +590,174 @@ class AutoClicker(threading.Thread):
         self.click_counts = {t["name"]: 0 for t in templates}
         self.on_update = on_update
         self.start_time = None
+        self._cam = None
+        self._stream = None
+        self._frames_gpu = None
+        self._last_hash = {}  # name -> (zone digest, match) from the previous scan of its zone
+        self._last_click = {}  # name -> (zone digest, time) of the last click
+        self._kernels_picked = False
 
         # preload templates
         for t in self.templates:
-            t["image"] = load_template(Path(t["path"]).resolve())
-            t["region_abs"] = region_from_percent(t["zone"])
+            prepare_template(t)
 
         # [NEW] preload automenu
-        self.automenu_img = load_template(Path(AUTOMENU_TEMPLATE["path"]).resolve())
-        self.automenu_region = region_from_percent(AUTOMENU_TEMPLATE["zone"])
+        self.automenu = prepare_template(AUTOMENU_TEMPLATE)
 
         # [NEW] reward
-        self.reward_img = load_template(Path(REWARD_TEMPLATE["path"]).resolve())
-        self.reward_region = region_from_percent(REWARD_TEMPLATE["zone"])
+        self.reward = prepare_template(REWARD_TEMPLATE)
+
+        # automenu and reward come first, their results gate the click pass
+        self.checks = [self.automenu, self.reward] + self.templates
+
+        # overlapping zones are grabbed once as a cluster and cropped from it,
+        # separate clusters keep the empty screen between them out of the grab
+        self.clusters, index = cluster_regions([t["region_abs"] for t in self.checks])
+        for t, k in zip(self.checks, index):
+            t["cluster"] = k
+        # grim spawns a process per grab, so on Wayland the clusters are cut from one grab of this box
+        self.scan_area = union_region(self.clusters)
+
+        # cv2.matchTemplate releases the GIL, so zones are matched on parallel threads
+        self._pool = ThreadPoolExecutor(max_workers=min(len(self.checks), os.cpu_count() or 1))
+
+    def screenshot_gray(self, region, frame=None):
+        """Universal grayscale screenshot for X11, Wayland (grim) and Windows
+
+        Every backend converts straight from what it captured, so no intermediate BGR copy is made.
+        frame is this cycle's bettercam frame, regions are cut from it instead of grabbed.
+        """
+        x, y, w, h = region
+        if frame is not None:
+            return cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_BGRA2GRAY)
+        if WAYLAND:
+            # grim crops itself and writes PPM to stdout: no temp file, no PNG encode/decode
+            out = subprocess.run(
+                ["grim", "-g", f"{x},{y} {w}x{h}", "-s", "1", "-t", "ppm", "-"],
+                check=True, capture_output=True,
+            ).stdout
+            return cv2.imdecode(np.frombuffer(out, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        monitor = {"top": y, "left": x, "width": w, "height": h}
+        shot = thread_sct().grab(monitor)
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2GRAY)
+
+    def _camera_fps(self):
+        if self.delay <= 0:
+            return CAMERA_MAX_FPS
+        # rounded up so one frame never takes longer than the delay, the scan loop waits out the rest
+        return min(CAMERA_MAX_FPS, math.ceil(1 / self.delay))
 
     def run(self):
         self.start_time = time.time()
+        if bettercam is not None:
+            # video mode hands out a frame every 1/fps, so the camera paces the scan loop
+            self._cam = bettercam.create(output_idx=0, output_color="BGRA")
+            self._cam.start(target_fps=self._camera_fps(), video_mode=True)
+        if USE_CUDA:
+            self._stream = cv2.cuda_Stream()
+            # one persistent upload target per cluster, the sizes never change during a run
+            self._frames_gpu = [cv2.cuda_GpuMat() for _ in self.clusters]
+        try:
+            self._scan_loop()
+        finally:
+            if self._cam is not None:
+                self._cam.stop()
+                self._cam = None
+            release_thread_sct()
+            self._pool.shutdown()
+
+    def _match(self, t, pyrs):
+        k = t["cluster"]
+        origin = self.clusters[k][:2]
+        crops = crop_pyramid(pyrs[k], t["region_abs"], origin)
+        digest = zone_digest(np.ascontiguousarray(crops[0]))
+        last = self._last_hash.get(t["name"])
+        if last is not None and last[0] == digest:
+            return last[1]  # same pixels as last cycle, same answer
+        if self._frames_gpu is not None:
+            match = match_template_cuda(self._frames_gpu[k], t, origin, self._stream)
+        else:
+            match = match_template(crops, t)
+        self._last_hash[t["name"]] = (digest, match)
+        return match
+
+    def _pick_kernels(self, pyrs):
+        """Build the specialized kernels and time each against cv2 on its full coarse zone, one template at a time
+
+        Runs on the worker, so a cold cffi compile does not block the GUI or hotkey thread.
+        Kernels are shared by every template of the same coarse size.
+        """
+        for t in self.checks:
+            if "coarse_zm" in t:
+                t["kernel"] = make_match_kernel(*t["coarse_zm"].shape)
+            if t["kernel"] is not None:
+                k = t["cluster"]
+                crops = crop_pyramid(pyrs[k], t["region_abs"], self.clusters[k][:2])
+                pick_kernel(crops[t["levels"]], t)
+        self._kernels_picked = True
+
+    def _scan_loop(self):
         while not self.stop_flag.is_set():
+            frame = self._cam.get_latest_frame() if self._cam is not None else None
+            # converted once per cycle, overlapping zones share the same gray pixels
+            if WAYLAND and frame is None:
+                ax, ay = self.scan_area[:2]
+                area = self.screenshot_gray(self.scan_area)
+                grays = [area[y - ay:y - ay + h, x - ax:x - ax + w] for x, y, w, h in self.clusters]
+            else:
+                grays = [self.screenshot_gray(c, frame) for c in self.clusters]
+            if self._frames_gpu is not None:
+                for frame_gpu, gray in zip(self._frames_gpu, grays):
+                    frame_gpu.upload(gray, self._stream)
+                # a single stream per worker, the GPU serializes the kernels anyway
+                pyrs = [[gray] for gray in grays]
+                matches = [self._match(t, pyrs) for t in self.checks]
+            else:
+                pyrs = [build_pyramid(gray, PYRAMID_LEVELS) for gray in grays]
+                if not self._kernels_picked:
+                    # before the pool starts, so the timings do not compete with other zones
+                    self._pick_kernels(pyrs)
+                matches = list(self._pool.map(lambda t: self._match(t, pyrs), self.checks))
+            found_menu, found_reward, *template_matches = matches
 
             # [NEW] check automenu first
-            automenu_screen = screenshot_region(self.automenu_region)
-            found_menu = match_template(
-                automenu_screen, self.automenu_img, AUTOMENU_TEMPLATE["threshold"]
-            )
             if found_menu:
                 print("[AutoMenu] Found automenu.png — pressing ESC → wait 2s → ENTER")
-                pyautogui.press("esc")
-                time.sleep(2)
-                pyautogui.press("enter")
-                time.sleep(self.delay)
+                press("esc")
+                if self.stop_flag.wait(2):
+                    break  # stopped mid-sequence, do not confirm anything
+                press("enter")
+                self.stop_flag.wait(self.delay)
                 continue
             
             # [NEW] check reward
-            reward_screen = screenshot_region(self.reward_region)
-            found_reward = match_template(
-                reward_screen, self.reward_img, REWARD_TEMPLATE["threshold"]
-            )
             if found_reward:
                 print("[Reward] Found reward.png — pressing ENTER")
-                pyautogui.press("enter")
-                time.sleep(self.delay)
+                press("enter")
+                self.stop_flag.wait(self.delay)
                 continue
             # normal templates loop
-            for t in self.templates:
+            for t, match in zip(self.templates, template_matches):
                 region = t["region_abs"]
-                screenshot = screenshot_region(region)
-                match = match_template(screenshot, t["image"], t["threshold"])
                 if match:
+                    digest = self._last_hash[t["name"]][0]
+                    last_click = self._last_click.get(t["name"])
+                    now = time.time()
+                    if last_click and last_click[0] == digest and now - last_click[1] < CLICK_DEBOUNCE:
+                        continue  # already clicked these exact pixels, give the game time to react
                     abs_x = region[0] + match[0]
                     abs_y = region[1] + match[1]
-                    pyautogui.click(abs_x, abs_y)
+                    click(abs_x, abs_y)
+                    self._last_click[t["name"]] = (digest, now)
                     self.click_counts[t["name"]] += 1
                     if self.on_update:
                         self.on_update(self.click_counts, time.time() - self.start_time)
-            time.sleep(self.delay)
+            if self._cam is None:
+                self.stop_flag.wait(self.delay)  # returns as soon as stop() is called
+            else:
+                # the frame interval is at most the delay, wait out whatever it does not cover
+                self.stop_flag.wait(max(0, self.delay - 1 / self._camera_fps()))
 
     def stop(self):
         self.stop_flag.set()
@@ -200,6 +778,7 @@ class App(ctk.CTk):
         self.mouse_pos_var = ctk.StringVar(value="x: 0, y: 0 (0.0%, 0.0%)")
 
         self.worker = None
+        self._last_mouse = None
 
         self._build_ui()
         self.update_mouse_position()
@@ -239,6 +818,7 @@ class App(ctk.CTk):
     def start_clicker(self):
         if self.worker and self.worker.is_alive():
             return
+        refresh_screen_size()  # the resolution may have changed since the last run
         self.worker = AutoClicker(TEMPLATES, self.delay_var.get(), on_update=self.update_status)
         self.worker.start()
         if start_sound:
@@ -264,12 +844,15 @@ class App(ctk.CTk):
         self.time_var.set(f"{elapsed:.1f} s")
 
     def update_mouse_position(self):
-        x, y = pyautogui.position()
-        sw, sh = pyautogui.size()
-        px = (x / sw) * 100
-        py_ = (y / sh) * 100
-        self.mouse_pos_var.set(f"x: {x}, y: {y}  ({px:.1f}%, {py_:.1f}%)")
-        self.after(500, self.update_mouse_position)
+        pos = cursor_position()
+        if pos != self._last_mouse:  # only touch the label, and redraw, when the cursor moved
+            self._last_mouse = pos
+            x, y = pos
+            sw, sh = _SCREEN_SIZE
+            px = (x / sw) * 100
+            py_ = (y / sh) * 100
+            self.mouse_pos_var.set(f"x: {x}, y: {y}  ({px:.1f}%, {py_:.1f}%)")
+        self.after(MOUSE_POLL_MS, self.update_mouse_position)
 
     def on_close(self):
         self.stop_clicker()
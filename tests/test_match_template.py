@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import pytest
+
+try:
+    import main
+except Exception as e:  # main opens the display and the mixer at import
+    pytest.skip(f"main.py cannot be imported here: {e}", allow_module_level=True)
+
+RESOLUTIONS = [(1920, 1080), (2560, 1440)]
+EDGE = 12  # last offsets checked at the right and bottom of each zone
+SHIFTS = [0, -45]  # gray levels added to the pasted template, NCC ignores a uniform offset
+
+
+def full_resolution_match(zone, t):
+    """Baseline: plain TM_CCOEFF_NORMED on the whole zone at full resolution"""
+    res = cv2.matchTemplate(zone, t["gray"], cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, (mx, my) = cv2.minMaxLoc(res)
+    if max_val >= t["threshold"]:
+        th, tw = t["shape"]
+        return (mx + tw // 2, my + th // 2)
+    return None
+
+
+@pytest.fixture(params=RESOLUTIONS, ids=lambda r: f"{r[0]}x{r[1]}")
+def screen_size(request):
+    saved = main._SCREEN_SIZE
+    main._SCREEN_SIZE = request.param
+    main.region_from_percent.cache_clear()
+    yield request.param
+    main._SCREEN_SIZE = saved
+    main.region_from_percent.cache_clear()
+
+
+@pytest.mark.parametrize("shift", SHIFTS)
+@pytest.mark.parametrize(
+    "template",
+    main.TEMPLATES + [main.AUTOMENU_TEMPLATE, main.REWARD_TEMPLATE],
+    ids=lambda t: t["name"],
+)
+def test_edge_placements_match_full_resolution(screen_size, template, shift):
+    """The coarse-to-fine matcher finds a template pasted at the zone's right and bottom edges like the baseline"""
+    w_screen, h_screen = screen_size
+    t = main.prepare_template(dict(template))
+    x, y, w, h = t["region_abs"]
+    th, tw = t["shape"]
+    rng = np.random.default_rng(0)
+    screen = cv2.GaussianBlur(rng.integers(0, 256, (h_screen, w_screen), dtype=np.uint8), (0, 0), 3)
+    pasted = np.clip(t["gray"].astype(np.int16) + shift, 0, 255).astype(np.uint8)
+    misses = []
+    for oy in range(h - th - EDGE + 1, h - th + 1):
+        for ox in range(w - tw - EDGE + 1, w - tw + 1):
+            shot = screen.copy()
+            shot[y + oy:y + oy + th, x + ox:x + ox + tw] = pasted
+            pyr = main.build_pyramid(shot, main.PYRAMID_LEVELS)
+            crops = main.crop_pyramid(pyr, t["region_abs"], (0, 0))
+            expected = full_resolution_match(crops[0], t)
+            assert expected == (ox + tw // 2, oy + th // 2)
+            if main.match_template(crops, t) != expected:
+                misses.append((ox, oy))
+    assert not misses